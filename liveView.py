@@ -0,0 +1,138 @@
+'''
+liveView.py
+
+Multi-resolution image pyramid for live detector display.
+Keeps 2x2, 4x4, 8x8, ... binned sums of the latest frame and of the running sum, so a display only
+redraws the level that matches its size and zoom instead of the full resolution float64 detector image.
+Only numpy is imported. matplotlib is only used through the axes passed to showLevel.
+
+'''
+
+import numpy as np
+
+def binFrame( frame , factor=2 ):
+    '''
+    Sums factor x factor blocks of pixels along the last two axes
+    Trailing rows and columns that do not fill a block are dropped.
+    input:
+        frame: image of size [..., NY, NX], e.g. a single MPCCD or a stack of tiles
+        factor: integer binning factor
+    output:
+        binned image of size [..., NY//factor, NX//factor]
+    '''
+    NY, NX = frame.shape[-2:]
+    NYb, NXb = NY//factor, NX//factor
+    cropped = frame[..., :NYb*factor, :NXb*factor]
+    return cropped.reshape( frame.shape[:-2] + (NYb, factor, NXb, factor) ).sum( axis=(-3,-1) )
+
+class imagePyramid(object):
+    '''
+        Running image pyramid of the latest frame and of the running sum.
+        Level 0 is full resolution, level k is binned by 2**k.
+    '''
+    def __init__(self, nlevels=4, dtype=np.float32):
+        '''
+            input:
+                nlevels: number of levels including full resolution. 4 gives 1x1, 2x2, 4x4 and 8x8.
+                dtype: dtype of the stored levels
+        '''
+        self.nlevels = nlevels
+        self.dtype = dtype
+        self.reset()
+
+    def reset(self):
+        '''
+            Clears the latest frame and the running sum
+        '''
+        self.latestLevels = None
+        self.sumLevels = None
+        self.nframes = 0
+        self.tag = None
+
+    def update(self, frame, tag=None):
+        '''
+            Adds a frame. Each level is binned from the level above it, so a frame is only read once at full resolution.
+            input:
+                frame: detector image of size [..., NY, NX]
+                tag: optional tag of the frame
+        '''
+        levels = [ np.asarray(frame, dtype=self.dtype) ]
+        for level in range(1, self.nlevels):
+            levels.append( binFrame(levels[-1], 2) )
+
+        if self.sumLevels is None or self.sumLevels[0].shape != levels[0].shape:
+            self.sumLevels = [ np.zeros_like(image) for image in levels ]
+            self.nframes = 0
+        for total, image in zip(self.sumLevels, levels):
+            total += image
+
+        self.latestLevels = levels
+        self.nframes += 1
+        self.tag = tag
+
+    def latest(self, level=0):
+        '''
+            Returns the latest frame at a level
+        '''
+        return self.latestLevels[level]
+
+    def average(self, level=0):
+        '''
+            Returns the running average at a level
+        '''
+        return self.sumLevels[level] / max(self.nframes, 1)
+
+    def levelFor(self, displayShape, visibleShape=None):
+        '''
+            Returns the coarsest level that still has at least one pixel per screen pixel
+            input:
+                displayShape: (ny, nx) screen pixels the image is drawn on
+                visibleShape: (ny, nx) full resolution pixels visible on screen, eg when zoomed in. Defaults to the whole frame.
+        '''
+        NY, NX = self.latestLevels[0].shape[-2:] if visibleShape is None else visibleShape
+        level = 0
+        while level+1 < self.nlevels and NY/2**(level+1) >= displayShape[0] and NX/2**(level+1) >= displayShape[1]:
+            level += 1
+        return level
+
+def displayShape( ax ):
+    '''
+    Returns the size of a matplotlib axes in screen pixels as (ny, nx)
+    '''
+    bbox = ax.get_window_extent()
+    return int(bbox.height), int(bbox.width)
+
+def visibleShape( ax, shape ):
+    '''
+    Returns the number of full resolution pixels inside the view limits of ax as (ny, nx), at most shape
+    '''
+    ylow, yhigh = ax.get_ylim()
+    xlow, xhigh = ax.get_xlim()
+    return min( abs(yhigh-ylow), shape[0] ), min( abs(xhigh-xlow), shape[1] )
+
+def showLevel( ax, pyramid, average=False, artist=None, **imshowkwargs ):
+    '''
+    Draws the pyramid level matching the size and zoom of ax, keeping full resolution pixel coordinates
+    The first call creates the image with imshow. Later calls reuse it with set_data, which is much cheaper than a new imshow.
+    input:
+        ax: matplotlib axes
+        pyramid: imagePyramid holding at least one 2D frame
+        average: if True show the running average, otherwise the latest frame
+        artist: image returned by a previous call, or None
+        imshowkwargs: passed to imshow on the first call
+    output:
+        image artist to pass to the next call
+    '''
+    NY, NX = pyramid.latest(0).shape[-2:]
+    # before the first imshow the view limits do not show the image yet
+    visible = None if artist is None else visibleShape( ax, (NY, NX) )
+    level = pyramid.levelFor( displayShape(ax), visible )
+    image = pyramid.average(level) if average else pyramid.latest(level)
+    extent = (-0.5, NX-0.5, NY-0.5, -0.5)
+    if artist is None:
+        artist = ax.imshow( image, extent=extent, interpolation='nearest', **imshowkwargs )
+    else:
+        artist.set_data( image )
+        artist.set_extent( extent )
+    artist.set_clim( np.nanmin(image), np.nanmax(image) )
+    return artist
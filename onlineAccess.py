@@ -8,20 +8,17 @@ by Matthew Ware, Takihiro Sato, Kathryn Ledbetter, and Jordan O'Neal
 # The MPCCD threshold value for no photons is fairly static. This should not need to be editted.
 thresholdValue = 1000./3.65
 #thresholdValue = -1000 # Set to negative to do no thresholding
-print('MPCCD threshold is set to %f' % thresholdValue)
-
-if thresholdValue < 1e-15:
-    print('WARNING MPCCD IS NOT BEING THRESHOLDED')
 
 
 ###################################################################################################################
 # Import required libraries
 ###################################################################################################################
 
+# pandas is only imported when making dataframes, and nothing here plots, so worker processes start quickly
 import os, io, time, sys, socket
+import multiprocessing
+import pickle
 import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
 
 # SACLA database library and online analysis library
 sys.path.append('/prj/SACLA_tool/lib')
@@ -30,6 +27,13 @@ import dbpy, olpy
 # Redirect output
 from contextlib import contextmanager
 
+# Only the main process prints the threshold banner, not every worker that imports this module
+if multiprocessing.current_process().name == 'MainProcess':
+    print('MPCCD threshold is set to %f' % thresholdValue)
+
+    if thresholdValue < 1e-15:
+        print('WARNING MPCCD IS NOT BEING THRESHOLDED')
+
 
 ###################################################################################################################
 # Useful function definitions
@@ -200,6 +204,36 @@ def getNewestHighTag( bl ):
 # Grabbing data and camera rois
 ###################################################################################################################
 
+def grabPointMatrix( pointDetectors , tags , hightag=201901, chunkSize=1000, dtype=np.float64 ):
+    '''
+    Grabs the point detector / equipment read out for many equipments over a large tag range into a single matrix
+    The tags are read chunkSize at a time. A chunk that fails to read, or returns the wrong number of values, is left as nan
+    so every column stays aligned with tags.
+    input:
+        pointDetectors: list of strings, e.g. ['xfel_bl_3_st_5_direct_bm_1_pd/charge','xfel_bl_3_shutter_1_open_valid/status']
+        tags: tuple of integers containing the low tag value
+        hightag: hightag integer
+        chunkSize: number of tags to read per database request
+        dtype: dtype of the matrix
+    output:
+        matrix of size [ntags, nequipment]. Column major, so every equipment column is contiguous.
+    '''
+    tags = tuple(tags)
+    pointMatrix = np.full( (len(tags), len(pointDetectors)), np.nan, dtype=dtype, order='F' )
+    for low in range(0, len(tags), chunkSize):
+        chunk = tags[low:low+chunkSize]
+        for col, equip in enumerate(pointDetectors):
+            try:
+                equipVals = dbpy.read_syncdatalist_float( equip, hightag , chunk )
+            except Exception as e:
+                logPrint('%s on tags %d to %d: %s' % ( equip, chunk[0], chunk[-1], str(e) ))
+                continue
+            if len(equipVals) != len(chunk):
+                logPrint('%s returned %d values for %d tags' % ( equip, len(equipVals), len(chunk) ))
+                continue
+            pointMatrix[low:low+len(chunk), col] = equipVals
+    return pointMatrix
+
 def grabPointData( pointDetectors , tags , hightag=201901 ):
     '''
     Grabs the point detector / equipment read out for each equipment in the pointDetector array of strings for each tag
@@ -208,9 +242,11 @@ def grabPointData( pointDetectors , tags , hightag=201901 ):
         tags: tuple of integers containing the low tag value
         hightag: hightag integer
     output: 
-        readout for each detector for each tag
+        readout for each detector for each tag, nan where the equipment could not be read.
+        Each 'Data' is a column of a single grabPointMatrix matrix.
     '''
-    pointData = { pd:{'Data':getEquip( tags , pd , hightag=hightag )} for pd in pointDetectors }
+    pointMatrix = grabPointMatrix( pointDetectors , tags , hightag=hightag )
+    pointData = { pd:{'Data':pointMatrix[:,col]} for col, pd in enumerate(pointDetectors) }
     pointData['tags'] = tags
     return pointData
 
@@ -239,14 +275,22 @@ def makeDataFrame( pointData ):
     '''
     Converts data and roi dictionaries into pandas dataframe with the tag numbers as indexes
     '''
+    import pandas as pd
     data={}
     for pid in pointData.keys():
-        if pid is not 'tags':
+        if pid != 'tags':
             data[pid] = np.array(pointData[pid]['Data'])
     index = pointData['tags']
     return pd.DataFrame( index=index, data=data )
 
-def grabDetector(det, tags, hightag=201901):
+def makeMatrixDataFrame( pointMatrix , pointDetectors , tags ):
+    '''
+    Wraps a grabPointMatrix matrix in a pandas dataframe with the tag numbers as indexes, without copying the matrix
+    '''
+    import pandas as pd
+    return pd.DataFrame( pointMatrix, index=tags, columns=pointDetectors, copy=False )
+
+def grabDetector(det, tags, hightag=201901, sparse=False, cluster=False):
     '''
     Grabs the detector object at the tags
     NOTE: The detector objects quickly leave memory. This cannot be used to look at old images.
@@ -254,8 +298,11 @@ def grabDetector(det, tags, hightag=201901):
         det: detector name
         tags: tuple of integers containing the low tag value
         hightag: high tag integer value
+        sparse: if True, return each calibrated frame as a photon list (see sparseFrames) instead of a dense stack.
+            Only worthwhile for thresholded MPCCD frames where most pixels are zero.
+        cluster: if True (and sparse), merge neighbouring pixels into droplets (see makeDroplets)
     output:
-        detector: Size is [ntags, NX, NY, NZ...]
+        detector: Size is [ntags, NX, NY, NZ...], or a sparseFrames object with ntags frames if sparse
     '''
     try: # this exception sometimes occurs. correct use of this function should include a catch statement somewhere
         objReader = olpy.StorageReader(det)
@@ -269,6 +316,11 @@ def grabDetector(det, tags, hightag=201901):
     initialized = False
     errorCount = 0
     isMPCCD = False
+
+    if sparse:
+        if cluster:
+            from scipy import ndimage # makeDroplets needs scipy. Fail here rather than on every tag.
+        detArrays = sparseFrames()
     
     for idx, tag in enumerate(tags):
       try:
@@ -280,38 +332,53 @@ def grabDetector(det, tags, hightag=201901):
             isMPCCD = True
         except KeyError as ex:
             gain = 1
-        if not initialized:
-            detArrays = np.zeros( ( len(tags), ) + detArray.shape )
-        detArrays[idx,:,:] = np.copy(detArray) * gain
+        if sparse:
+            detArray = detArray * gain
+            if isMPCCD:
+                detArray[detArray < thresholdValue] = 0.
+        else:
+            if not initialized:
+                detArrays = np.zeros( ( len(tags), ) + detArray.shape )
+                initialized = True
+            detArrays[idx,:,:] = np.copy(detArray) * gain
       except Exception as ex:
         logPrint(str(ex))
         errorCount +=1
+        if sparse:
+            detArrays.appendEmpty()
+        continue
+      if sparse:
+        # outside the read error handler, so errors while building the photon list reach the caller
+        detArrays.appendFrame(detArray, cluster=cluster)
 
     logPrint('Errored on %d of %d tags'%( errorCount , len(tags) ))
         
-    if isMPCCD:
+    if isMPCCD and not sparse:
         detArrays[detArrays < thresholdValue] = 0.
     return detArrays
 
-def grabNewestDetector(det, bl, refDet='xfel_bl_3_st_5_direct_bm_1_pd/charge'):
+def grabNewestDetector(det, bl, refDet='xfel_bl_3_st_5_direct_bm_1_pd/charge', sparse=False):
     '''
     Grabs the newest detector image
     input:
         det: detector name
         bl: beamline as integer value
         refDet: reference det to get current tag value
+        sparse: if True, return a single-frame sparseFrames object instead of a dense image
     output:
         detector: Size is [NX, NY, NZ...]
     '''
     
     tag = [getNewestTag(refDet)]
     hightag= getNewestHighTag(bl)
-    detArray = grabDetector(det, tag, hightag=hightag)  
+    detArray = grabDetector(det, tag, hightag=hightag, sparse=sparse)  
 
+    if sparse:
+        return detArray, tag[0], hightag
     return np.squeeze(detArray), tag[0], hightag
 
 def grabROI(det, tags, X1, X2, Y1, Y2, 
-                 hightag=201901):
+                 hightag=201901, returnRealTags=False):
     '''
     Caslculates roi of detector across tags
     input:
@@ -320,8 +387,10 @@ def grabROI(det, tags, X1, X2, Y1, Y2,
         X1, Y1:lowert indexes of ROI
         X2: Y2: upper indexes of ROI
         hightag: hightag integer
+        returnRealTags: if True, also return the tag the storage reader actually collected for each requested tag
     output:
         roi value across tags
+        if returnRealTags: roi value across tags, real tags (nan where the tag errored)
     '''
     try: # this exception sometimes occurs. correct use of this function should include a catch statement somewhere
         objReader = olpy.StorageReader(det)
@@ -333,6 +402,7 @@ def grabROI(det, tags, X1, X2, Y1, Y2,
         raise
 
     detROIs = np.array([0. for tag in tags])
+    realTags = np.full( len(tags), np.nan )
 
     errorCount = 0
     
@@ -349,6 +419,8 @@ def grabROI(det, tags, X1, X2, Y1, Y2,
                 gain = 1.
             NX,NY = detArray.shape
             detROIs[idx] = np.nansum( detArray[Y1:Y2,X1:X2] )
+            # only recorded once the roi is summed, so a tag that errored is not reported as collected
+            realTags[idx] = realtag
         except Exception as ex:
             logPrint(str(ex))
             logPrint(str(det))
@@ -356,9 +428,52 @@ def grabROI(det, tags, X1, X2, Y1, Y2,
 
     logPrint('Errored on %d of %d tags'%( errorCount , len(tags) ))
         
+    if returnRealTags:
+        return detROIs, realTags
     return detROIs
 
-def grabROIData( rois , tags , hightag=201901 ):
+def iterCalibratedFrames( det, tags, hightag=201901 ):
+    '''
+    Reads the gain corrected and thresholded frame for each tag, one at a time, so several consumers can share each read
+    input:
+        det: detector name
+        tags: tags to grab detector image on
+        hightag: hightag integer
+    output:
+        generator of (index into tags, tag actually collected, frame). realtag is nan and frame is None where the tag errored.
+    '''
+    try: # this exception sometimes occurs. correct use of this function should include a catch statement somewhere
+        objReader = olpy.StorageReader(det)
+        objBuffer = olpy.StorageBuffer(objReader)
+    except Exception as ex:
+        logPrint(str(ex))
+        logPrint(str(det))
+        raise
+
+    errorCount = 0
+
+    for idx, tag in enumerate(tags):
+        try:
+            realtag = objReader.collect(objBuffer, tag)
+            detArray = (objBuffer.read_det_data(0)) 
+            detInfo = objBuffer.read_det_info(0)
+            try:
+                gain = np.copy(detInfo['mp_absgain'])
+                detArray = detArray*gain
+                detArray[detArray<thresholdValue] = 0.
+            except KeyError as ex:
+                gain = 1.
+        except Exception as ex:
+            logPrint(str(ex))
+            logPrint(str(det))
+            errorCount +=1
+            yield idx, np.nan, None
+            continue
+        yield idx, realtag, detArray
+
+    logPrint('Errored on %d of %d tags'%( errorCount , len(tags) ))
+
+def grabROIData( rois , tags , hightag=201901, returnRealTags=False ):
     '''
     Calculates roi for each roi in the suppled dictionary
     input:
@@ -370,6 +485,7 @@ def grabROIData( rois , tags , hightag=201901 ):
                  'Y2':10} }   
         tags: tags to grab values across
         hightag: hightag integer
+        returnRealTags: if True, each roi dictionary also holds the collected tags under 'RealTags'
     output:
         returns every roi value across the tags
     '''
@@ -380,7 +496,11 @@ def grabROIData( rois , tags , hightag=201901 ):
         X2 = rois[roi]['X2']
         Y1 = rois[roi]['Y1']
         Y2 = rois[roi]['Y2']
-        roiData[roi] = { 'Data':grabROI(det, tags, X1, X2, Y1, Y2, hightag=hightag), 'Detector':det, 'X1':X1, 'X2':X2, 'Y1':Y1, 'Y2':Y2 }
+        roiData[roi] = { 'Detector':det, 'X1':X1, 'X2':X2, 'Y1':Y1, 'Y2':Y2 }
+        if returnRealTags:
+            roiData[roi]['Data'], roiData[roi]['RealTags'] = grabROI(det, tags, X1, X2, Y1, Y2, hightag=hightag, returnRealTags=True)
+        else:
+            roiData[roi]['Data'] = grabROI(det, tags, X1, X2, Y1, Y2, hightag=hightag)
     roiData['tags'] = tags
     return roiData
 
@@ -430,6 +550,22 @@ def grabNewestData( pointDetectors, rois ,
     output: 
         readout for each detector for each of the ngrab tags
     '''
+    tags, hightag = newestTagRange( ngrab=ngrab, bl=bl, refDet=refDet, lowestTag2Grab=lowestTag2Grab )
+    if len(tags) == 0:
+        return None
+    return grabData( pointDetectors, rois, tags, hightag=hightag )
+
+def newestTagRange( ngrab=30, bl=3 , refDet='xfel_bl_3_tc_bm_2_pd/charge', lowestTag2Grab = None ):
+    '''
+    Finds the most recent tags to grab
+    input:
+        ngrab: integer number of tags to grab
+        bl: integer beamline
+        refDet: which detector to use to get newest tag number
+        lowestTag2Grab: prevents grabbing beyond a certain tag, i.e. you don't want to double grab from a previous request
+    output:
+        tuple of tags, hightag
+    '''
     hightag = getNewestHighTag( bl )
 
     tagf = getNewestTag( refDet )
@@ -439,29 +575,315 @@ def grabNewestData( pointDetectors, rois ,
         if tagLow <= lowestTag2Grab:
             tagLow = lowestTag2Grab + 1
     tags = tuple([ idx for idx in range(tagLow, tagf)])
-    if len(tags) == 0:
-        return None
-    roiDataDicts  = grabROIData( rois , tags , hightag=hightag)
+    return tags, hightag
+
+def grabData( pointDetectors, rois, tags, hightag=201901, returnRealTags=False ):
+    '''
+    Grabs point and roi data for the specified tags
+    input:
+        pointDetectors: list of strings, e.g. ['xfel_bl_3_st_5_direct_bm_1_pd/charge','xfel_bl_3_shutter_1_open_valid/status']
+        rois: dictionary of rois as in grabNewestData
+        tags: tuple of integers containing the low tag value
+        hightag: hightag integer
+        returnRealTags: if True, each roi dictionary also holds the collected tags under 'RealTags'
+    output:
+        readout for each detector and roi for each tag
+    '''
+    roiDataDicts  = grabROIData( rois , tags , hightag=hightag, returnRealTags=returnRealTags )
     pointDataDicts = grabPointData( pointDetectors , tags , hightag=hightag )
     pointDataDicts.pop( 'tags' , None )
     return merge_dictionaries( roiDataDicts, pointDataDicts )
 
+def concatenateData( dataList ):
+    '''
+    Joins the outputs of several grabData calls on consecutive tag ranges into a single output of the same structure
+    input: list of data dictionaries returned by grabData
+    output: merged data dictionary
+    '''
+    data = {}
+    for key in dataList[0].keys():
+        if key == 'tags':
+            data[key] = tuple( tag for chunk in dataList for tag in chunk[key] )
+        else:
+            data[key] = dict( dataList[0][key] )
+            for subKey in ('Data', 'RealTags'):
+                if subKey in data[key]:
+                    data[key][subKey] = np.concatenate( [ np.atleast_1d(chunk[key][subKey]) for chunk in dataList ] )
+    return data
+
+def grabDataChunk( args ):
+    '''
+    grabData called with a single argument tuple (pointDetectors, rois, tags, hightag) for use with multiprocessing.Pool
+    '''
+    pointDetectors, rois, tags, hightag = args
+    return grabData( pointDetectors, rois, tags, hightag=hightag )
+
+def grabCallableChunk( args ):
+    '''
+    grab(tags, hightag=hightag) called with a single argument tuple (grab, tags, hightag) for use with multiprocessing.Pool
+    '''
+    grab, tags, hightag = args
+    return grab( tags, hightag=hightag )
+
+def replayRun( pointDetectors, rois, bl, run, chunkSize=1000, nworkers=4, progress=True, grab=None ):
+    '''
+    Grabs point and roi data for every tag of a completed run as fast as the database allows
+    The tag range is split into chunks which are grabbed in parallel worker processes.
+    NOTE: images are read through olpy like grabROI, so rois only work while the run is still held by the online storage.
+    input:
+        pointDetectors: list of strings, e.g. ['xfel_bl_3_st_5_direct_bm_1_pd/charge','xfel_bl_3_shutter_1_open_valid/status']
+        rois: dictionary of rois as in grabNewestData
+        bl: integer beamline
+        run: integer run number
+        chunkSize: number of tags to grab per chunk
+        nworkers: number of worker processes. Set to 1 to grab in this process.
+        progress: if True, print progress after each chunk
+        grab: optional callable grab(tags, hightag=hightag) returning the grabData structure, eg pipelinePlan.grabData.
+            Used instead of pointDetectors and rois. It is sent to the workers, so a pipeline must use module level
+            functions or functools.partial instead of lambdas. Otherwise chunks are grabbed in this process.
+    output:
+        readout for each detector and roi for each tag of the run, as returned by grabData
+    '''
+    startTag, endTag = getTagRange( bl, run )
+    hightag = startTag[0]
+    allTags = range( startTag[1], endTag[1] + 1 )
+    if grab is None:
+        worker = grabDataChunk
+        chunks = [ (pointDetectors, rois, tuple(allTags[idx:idx+chunkSize]), hightag) for idx in range(0, len(allTags), chunkSize) ]
+    else:
+        worker = grabCallableChunk
+        chunks = [ (grab, tuple(allTags[idx:idx+chunkSize]), hightag) for idx in range(0, len(allTags), chunkSize) ]
+        if nworkers > 1:
+            try:
+                pickle.dumps( grab )
+            except Exception as ex:
+                print('Replaying run %d in this process, the grab function cannot be sent to workers: %s' % ( run, str(ex) ))
+                nworkers = 1
+
+    t0 = time.time()
+    def report( dataList ):
+        if progress:
+            ndone = sum( len(chunk['tags']) for chunk in dataList )
+            print('Replayed %d of %d tags of run %d in %.1f s' % ( ndone, len(allTags), run, time.time()-t0 ))
+
+    dataList = []
+    if nworkers > 1:
+        # forkserver workers only import onlineAccess instead of inheriting whatever the caller (eg a notebook) has loaded
+        pool = multiprocessing.get_context('forkserver').Pool( nworkers )
+        try:
+            for data in pool.imap( worker, chunks ):
+                dataList.append( data )
+                report( dataList )
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for chunk in chunks:
+            dataList.append( worker(chunk) )
+            report( dataList )
+    return concatenateData( dataList )
+
+def contiguousTagRanges( tags ):
+    '''
+    Groups tags into contiguous ranges
+    input: iterable of integer tags
+    output: list of (first tag, last tag) tuples
+    '''
+    tags = np.unique( np.asarray(tags, dtype=np.int64) )
+    if len(tags) == 0:
+        return []
+    breaks = np.flatnonzero( np.diff(tags) > 1 )
+    starts = np.concatenate( ([tags[0]], tags[breaks+1]) )
+    ends = np.concatenate( (tags[breaks], [tags[-1]]) )
+    return [ (int(start), int(end)) for start, end in zip(starts, ends) ]
+
 
 
 
 
+###################################################################################################################
+# Sparse photon lists for thresholded detector frames
+###################################################################################################################
+
+def makeDroplets( frame ):
+    '''
+    Merges connected nonzero pixels of a thresholded frame into droplets
+    Each droplet is placed at the pixel nearest its intensity weighted centroid and carries the summed intensity
+    Requires scipy
+    input:
+        frame: thresholded detector frame of size [..., NY, NX], e.g. a single MPCCD or a stack of tiles
+    output:
+        flat pixel indices, droplet values
+    '''
+    from scipy import ndimage
+    # pixels only connect within the last two axes, so the same pixel of neighbouring tiles never merges
+    structure = np.zeros( (3,)*frame.ndim, dtype=bool )
+    structure[ (1,)*(frame.ndim-2) ] = ndimage.generate_binary_structure( 2, 1 )
+    labels, nDroplets = ndimage.label( frame > 0, structure=structure )
+    if nDroplets == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+    labelIdxs = np.arange(1, nDroplets+1)
+    values = ndimage.sum( frame, labels, labelIdxs )
+    centers = np.array( ndimage.center_of_mass( frame, labels, labelIdxs ) ).reshape(nDroplets, frame.ndim)
+    centers = np.clip( np.rint(centers).astype(np.int64), 0, np.array(frame.shape)-1 )
+    indices = np.ravel_multi_index( tuple(centers.T), frame.shape )
+    return indices, values
+
+class sparseFrames(object):
+    '''
+        Stores a stack of thresholded detector frames as photon lists, ie flat pixel index plus value for every nonzero pixel.
+        Dense frames are only rebuilt when asked for. ROI sums, radial profiles and accumulation work on the lists directly.
+    '''
+    def __init__(self, shape=None, valueDtype=np.float32):
+        '''
+            input:
+                shape: shape of a single frame. Set by the first appended frame if None.
+                valueDtype: dtype used to store pixel values
+        '''
+        self.shape = shape
+        self.valueDtype = valueDtype
+        self.indices = []
+        self.values = []
+
+    def appendFrame(self, frame, cluster=False):
+        '''
+            Adds a dense, already thresholded frame to the list
+            input:
+                frame: detector frame
+                cluster: if True, store droplets (see makeDroplets) instead of single pixels
+        '''
+        if self.shape is None:
+            self.shape = frame.shape
+        if cluster:
+            indices, values = makeDroplets( frame )
+        else:
+            indices = np.flatnonzero( frame )
+            values = frame.ravel()[indices]
+        self.indices.append( indices.astype(np.int32) )
+        self.values.append( np.asarray(values, dtype=self.valueDtype) )
+
+    def appendEmpty(self):
+        '''
+            Adds a frame with no photons, eg for a tag that could not be read
+        '''
+        self.indices.append( np.zeros(0, dtype=np.int32) )
+        self.values.append( np.zeros(0, dtype=self.valueDtype) )
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, idx):
+        '''
+            Returns the dense frame number idx
+        '''
+        frame = np.zeros( self.shape )
+        frame.ravel()[self.indices[idx]] = self.values[idx]
+        return frame
+
+    def toDense(self):
+        '''
+            Returns the dense stack. Size is [nframes, NX, NY, ...] as returned by grabDetector
+        '''
+        detArrays = np.zeros( (len(self),) + tuple(self.shape) )
+        for idx in range(len(self)):
+            detArrays[idx].ravel()[self.indices[idx]] = self.values[idx]
+        return detArrays
+
+    @property
+    def nbytes(self):
+        '''
+            Returns the memory used by the photon lists in bytes
+        '''
+        return sum( ind.nbytes + val.nbytes for ind, val in zip(self.indices, self.values) )
+
+    def maskSum(self, mask):
+        '''
+            Sums every frame over a boolean mask with the shape of a frame
+            output: sum for each frame
+        '''
+        flatMask = np.asarray(mask, dtype=bool).ravel()
+        return np.array([ np.sum( val[flatMask[ind]], dtype=np.float64 ) for ind, val in zip(self.indices, self.values) ])
+
+    def roiSum(self, X1, X2, Y1, Y2):
+        '''
+            Sums every frame over a rectangular roi, indexed like grabROI ie frame[Y1:Y2,X1:X2]
+            For tiled frames of size [ntile, NY, NX] the roi is taken on the last two axes of every tile and summed.
+            output: roi value for each frame
+        '''
+        sums = np.zeros( len(self) )
+        for idx, (ind, val) in enumerate(zip(self.indices, self.values)):
+            yy, xx = np.unravel_index( ind, self.shape )[-2:]
+            inROI = (yy >= Y1) & (yy < Y2) & (xx >= X1) & (xx < X2)
+            sums[idx] = np.sum( val[inROI], dtype=np.float64 )
+        return sums
+
+    def accumulate(self):
+        '''
+            Returns the dense sum of all frames
+        '''
+        if len(self) == 0:
+            return np.zeros( self.shape )
+        total = np.bincount( np.concatenate(self.indices), weights=np.concatenate(self.values),
+                            minlength=int(np.prod(self.shape)) )
+        return total.reshape( self.shape )
+
+    def radialProfile(self, xc, yc, nbins=100, rmax=None):
+        '''
+            Azimuthally averaged intensity of the mean frame around (xc, yc)
+            input:
+                xc, yc: center in pixels along the second and first frame axes
+                nbins: number of radial bins
+                rmax: outer radius, defaults to the frame corner furthest from the center
+            output:
+                mean intensity per pixel in each bin, bin centers
+        '''
+        if len(self.shape) != 2:
+            raise ValueError('radialProfile needs 2D frames, not frames of shape %s' % str(self.shape))
+        NY, NX = self.shape
+        if rmax is None:
+            rmax = np.sqrt( max(xc, NX-xc)**2. + max(yc, NY-yc)**2. )
+        edges = np.linspace( 0, rmax, nbins+1 )
+        centers = 0.5 * (edges[:-1] + edges[1:])
+
+        YY, XX = np.indices( (NY, NX) )
+        pixelCounts, _ = np.histogram( np.sqrt( (XX-xc)**2. + (YY-yc)**2. ), bins=edges )
+        if len(self) == 0:
+            return np.zeros(nbins), centers
+
+        allIndices = np.concatenate(self.indices)
+        yy, xx = np.unravel_index( allIndices, (NY, NX) )
+        sums, _ = np.histogram( np.sqrt( (xx-xc)**2. + (yy-yc)**2. ), bins=edges, weights=np.concatenate(self.values) )
+        with np.errstate(divide='ignore', invalid='ignore'):
+            profile = sums / (pixelCounts * len(self))
+        profile[pixelCounts == 0] = 0.
+        return profile, centers
+
+
 ###################################################################################################################
 # Use threaded class to load data in queue
 ###################################################################################################################
 
 import threading
 import collections
+import itertools
+
+import tagIndex
+
+class dataSnapshot(dict):
+    '''
+		A consistent copy of the data stored by a dataHandler, as returned by dataHandler.snapshot.
+		Indexed like the dataHandler, eg snapshot['tags']. version is the dataHandler version it was taken at.
+    '''
+    def __init__(self, data, version):
+        dict.__init__(self, data)
+        self.version = version
 
 class dataHandler(threading.Thread):
     '''
 		Generates a thread to pull in the point detector variables asynchronously with plotting.
     '''
-    def __init__(self, bl=3, refDet='xfel_bl_3_tc_bm_2_pd/charge', ngrab=120, maxTags2Save = 2000):
+    def __init__(self, bl=3, refDet='xfel_bl_3_tc_bm_2_pd/charge', ngrab=120, maxTags2Save = 2000,
+                 catchUp=False, minGrab=30, maxGrab=600, maxBacklog=3000, cycleTime=1.0):
         '''
 			Initializes the thread. 
 			input:
@@ -469,6 +891,13 @@ class dataHandler(threading.Thread):
 				refDet: detector to use as a reference for tag number
 				ngrab: number of tags to grab at a time. 120 seems optimal.
 				maxTags2Save: number of event information to store at a time
+				catchUp: if True, fetch every tag after the first one instead of only the newest ngrab tags.
+					ngrab then adapts to the rep rate and processing speed, see catchUpCycle.
+				minGrab, maxGrab: bounds on the adaptive ngrab in catch up mode. maxGrab bounds each backlog chunk.
+				maxBacklog: in catch up mode, tags further than this behind the newest tag are reported as gaps
+					instead of fetched, since the detector buffers no longer hold them.
+				cycleTime: in catch up mode, seconds of beam to grab per cycle once caught up, and the longest a cycle
+					should take to process
 		'''
         threading.Thread.__init__(self)
         self.lock=threading.Lock()
@@ -476,6 +905,9 @@ class dataHandler(threading.Thread):
         self.isPaused = False
         self.pauseRequested = False
         self.newestTag = None
+        self.version = 0
+        self.lastSnapshot = None
+        self.lastHistory = None
         self.dequeDicts = {'tags': collections.deque([np.nan],maxTags2Save), 'dummy':collections.deque([1],maxTags2Save)}
         
         self.ngrab = ngrab
@@ -492,6 +924,20 @@ class dataHandler(threading.Thread):
 
         self.rois = {}
         self.pointDetectors = {}
+        self.pipeline = None
+
+        self.catchUp = catchUp
+        self.minGrab = minGrab
+        self.maxGrab = maxGrab
+        self.maxBacklog = maxBacklog
+        self.cycleTime = cycleTime
+        self.gaps = []
+        self.nGapTags = 0
+        self.backlog = 0
+        self.repRate = None
+        self.processRate = None
+        self.lastNewestTag = None
+        self.lastNewestTime = None
         
     def setPointDetector(self, pointDetectors):
         '''
@@ -530,10 +976,36 @@ class dataHandler(threading.Thread):
                 raise ValueError('Detector %s not available' % rois[roiName]['Detector'])
         
         dequeDictROIs = { roiName : collections.deque([np.nan],self.maxTags2Save) for roiName in rois.keys()}
-        self.dequeDicts = merge_dictionaries( self.dequeDicts, dequeDictROIs )
+        dequeDictRealTags = { roiName+tagIndex.realTagSuffix : collections.deque([np.nan],self.maxTags2Save) for roiName in rois.keys()}
+        self.dequeDicts = merge_dictionaries( self.dequeDicts, dequeDictROIs, dequeDictRealTags )
         
         self.status += ', rois initialized'
         
+    def setPipeline(self, pipeline):
+        '''
+			Declare a pipeline.pipelinePlan to evaluate instead of separate point detectors and ROIs.
+			Each raw source is then read once per tag and every per tag output of the pipeline is stored.
+			input:
+				pipeline: pipeline.pipelinePlan
+		'''
+        self.pipeline = pipeline
+
+        dequeDictOutputs = { name : collections.deque([np.nan],self.maxTags2Save) for name in pipeline.perTagOutputs }
+        dequeDictRealTags = { name+tagIndex.realTagSuffix : collections.deque([np.nan],self.maxTags2Save)
+                             for name in pipeline.perTagOutputs if len(pipeline.detectorsOf(name)) > 0 }
+        self.dequeDicts = merge_dictionaries( self.dequeDicts, dequeDictOutputs, dequeDictRealTags )
+
+        self.status += ', pipeline initialized'
+
+    def grabTags(self, tags, hightag, returnRealTags=False):
+        '''
+			Grabs the declared data for tags, through the pipeline if one is set.
+			Called within thread. Not for user use.
+		'''
+        if self.pipeline is not None:
+            return self.pipeline.grabData( tags, hightag=hightag, returnRealTags=returnRealTags )
+        return grabData( self.pointDetectors, self.rois, tags, hightag=hightag, returnRealTags=returnRealTags )
+
     def run(self):
         '''
 			Main thread. Begin by running dh.start(), where dh is the initialized dataHandler object.
@@ -547,13 +1019,17 @@ class dataHandler(threading.Thread):
                 self.isPaused = True
             self.isPaused = False               
 
+            if self.catchUp:
+                self.catchUpCycle()
+                continue
 
             #with open('/xnas/xufs06/mrware/TAIS2019/grabber.out', 'w+') as out:
             #    with custom_redirection(out):
-            data = grabNewestData( self.pointDetectors, self.rois, ngrab=self.ngrab, 
+            tags, hightag = newestTagRange( ngrab=self.ngrab, 
             lowestTag2Grab=self.newestTag, bl=self.bl, refDet=self.refDet )
-            if data is None:
+            if len(tags) == 0:
                 continue
+            data = self.grabTags( tags, hightag, returnRealTags=True )
             
             if len(data['tags'])<=0: 
                 continue
@@ -567,10 +1043,133 @@ class dataHandler(threading.Thread):
         self.status += ', run completed.'
         self.last_status = 'run completed'
 
+    def loadRun(self, run, chunkSize=1000, nworkers=4, progress=True):
+        '''
+		Fills the stored data with every tag of a completed run instead of the newest tags, see replayRun.
+		Call after setPointDetector and setROIs, or setPipeline, in place of start().
+		maxTags2Save is raised to the number of tags in the run if needed, so the whole run is kept.
+		A pipeline is only replayed in parallel if it can be pickled, see replayRun.
+		input:
+			run: run number as integer
+			chunkSize: number of tags to grab per chunk
+			nworkers: number of worker processes
+			progress: if True, print progress after each chunk
+		'''
+        self.status += ', replaying run %d' % run
+        grab = None if self.pipeline is None else self.pipeline.grabData
+        data = replayRun( self.pointDetectors, self.rois, self.bl, run, chunkSize=chunkSize, nworkers=nworkers, progress=progress,
+                          grab=grab )
+        if len(data['tags']) > self.maxTags2Save:
+            if progress:
+                print('Raising maxTags2Save from %d to %d to keep every tag of run %d' % ( self.maxTags2Save, len(data['tags']), run ))
+            self.lock.acquire()
+            self.maxTags2Save = len(data['tags'])
+            for key in self.dequeDicts.keys():
+                self.dequeDicts[key] = collections.deque( self.dequeDicts[key], self.maxTags2Save )
+            self.lock.release()
+        if len(data['tags']) > 0:
+            self.newestTag = max(data['tags'])
+            self.updateDeques( data )
+        self.totalGrabbed = len(self.dequeDicts['tags'])
+        self.status += ', replay completed'
+        self.last_status = 'replay completed'
+
+    def recordGap(self, tagStart, tagEnd):
+        '''
+		Records tags tagStart to tagEnd (inclusive) as unrecoverable.
+		Called within thread. Not for user use.
+		'''
+        self.gaps.append( (tagStart, tagEnd) )
+        self.nGapTags += tagEnd - tagStart + 1
+        logPrint('Tags %d to %d could not be grabbed' % (tagStart, tagEnd))
+
+    def catchUpCycle(self):
+        '''
+		A single acquisition cycle in catch up mode.
+		Grabs the next ngrab tags after the last contiguous tag grabbed (self.newestTag), so no tag is skipped while
+		the backlog is smaller than maxBacklog. ngrab grows while there is a backlog and otherwise follows the rep rate
+		measured from the reference detector, but never exceeds the tags processed in cycleTime, so a cycle stays about
+		cycleTime long when processing is the bottleneck. Tags that fall out of the backlog window, or whose image the storage reader
+		no longer holds, are recorded in self.gaps.
+		Called within thread. Not for user use.
+		'''
+        t0 = time.time()
+        hightag = getNewestHighTag( self.bl )
+        tagf = getNewestTag( self.refDet )
+
+        # rep rate from the advance of the newest tag
+        if self.lastNewestTag is not None and tagf > self.lastNewestTag:
+            rate = (tagf - self.lastNewestTag) / (t0 - self.lastNewestTime)
+            self.repRate = rate if self.repRate is None else 0.8*self.repRate + 0.2*rate
+        if self.lastNewestTag is None or tagf > self.lastNewestTag:
+            self.lastNewestTag = tagf
+            self.lastNewestTime = t0
+
+        if self.newestTag is None:
+            self.newestTag = tagf - self.ngrab - 1
+
+        # the newest tag itself is not grabbed, as in grabNewestData
+        oldestKept = tagf - 1 - self.maxBacklog
+        if self.newestTag < oldestKept:
+            self.recordGap( self.newestTag + 1, oldestKept )
+            self.newestTag = oldestKept
+
+        tags = tuple(range( self.newestTag + 1, min(self.newestTag + 1 + self.ngrab, tagf) ))
+        if len(tags) == 0:
+            time.sleep(1./30.)
+            return
+
+        data = self.grabTags( tags, hightag, returnRealTags=True )
+
+        imageKeys = [ key for key in data.keys() if key != 'tags' and 'RealTags' in data[key] ]
+        missing = np.zeros( len(tags), dtype=bool )
+        for key in imageKeys:
+            missing |= ( data[key]['RealTags'] != np.array(tags) )
+        for key in imageKeys:
+            # a discarded value must not keep a real tag, or its stream would hold the collected tag twice
+            data[key]['Data'][missing] = np.nan
+            data[key]['RealTags'][missing] = np.nan
+        for tagStart, tagEnd in contiguousTagRanges( np.array(tags)[missing] ):
+            self.recordGap( tagStart, tagEnd )
+
+        self.newestTag = max(tags)
+        self.updateDeques( data )
+        self.totalGrabbed = len(self.dequeDicts['tags'])
+
+        # adapt the batch size
+        elapsed = time.time() - t0
+        rate = len(tags) / max(elapsed, 1e-6)
+        self.processRate = rate if self.processRate is None else 0.8*self.processRate + 0.2*rate
+        self.backlog = tagf - 1 - self.newestTag
+        if self.backlog > 0:
+            ngrab = max( self.ngrab*2, self.backlog )
+        elif self.repRate is not None:
+            ngrab = self.repRate * self.cycleTime
+        else:
+            ngrab = self.ngrab
+        ngrab = min( ngrab, self.processRate * self.cycleTime )
+        self.ngrab = int( min( max(ngrab, self.minGrab), self.maxGrab ) )
+
+        if self.backlog <= 0:
+            while time.time()-t0 < self.cycleTime:
+                time.sleep(1./30.)
+
+    def gapReport(self):
+        '''
+		Returns a summary of the catch up mode throughput and of the tags that could not be grabbed.
+		'''
+        report = '%d tags missed in %d gaps, backlog %d tags, ngrab %d' % ( self.nGapTags, len(self.gaps), self.backlog, self.ngrab )
+        if self.repRate is not None:
+            report += ', rep rate %.1f Hz' % self.repRate
+        if self.processRate is not None:
+            report += ', processing %.1f tags/s' % self.processRate
+        return report
+
     def pause(self):
         '''
 		Requests a pause in execution of the thread.
 		Before accessing stored data, wait for self.isPaused eg dh.isPaused to return True.
+		Not needed for plotting, use snapshot instead.
 		'''
         self.pauseRequested = True
 
@@ -598,7 +1197,13 @@ class dataHandler(threading.Thread):
                 self.dequeDicts[key].extend(np.copy(data[key]))
                 self.dequeDicts['dummy'].extend(np.ones_like(np.array(data[key])))
             else:           
-                self.dequeDicts[key].extend( np.copy(data[key]['Data']) )
+                self.dequeDicts[key].extend( np.asarray(data[key]['Data']).tolist() )
+                # the tag each image value was actually collected at, nan if it was not recorded
+                realTagKey = key + tagIndex.realTagSuffix
+                if realTagKey in self.dequeDicts:
+                    realTags = data[key].get( 'RealTags', np.full( len(data[key]['Data']), np.nan ) )
+                    self.dequeDicts[realTagKey].extend( np.asarray(realTags).tolist() )
+        self.version += 1
         self.lock.release()
 
     def keys(self):
@@ -616,6 +1221,66 @@ class dataHandler(threading.Thread):
         self.lock.release()
         return data
 
+    def snapshot(self, keys=None, last=None):
+        '''
+		Returns a consistent, tag aligned copy of several stored channels without pausing the thread.
+		All channels are copied under a single lock, so they always come from the same set of grabbed tags.
+		The copy is reused until new data arrives, so polling this faster than the data arrives is cheap.
+		Treat the returned arrays as read only.
+		input:
+			keys: list of detectors and ROIs to copy. 'tags' is always included. None copies every key.
+			last: only copy the newest last tags. None copies everything stored.
+		output:
+			dataSnapshot, a dictionary of arrays with the version of the data as snapshot.version
+		'''
+        keys = list(self.dequeDicts.keys()) if keys is None else ['tags'] + [ key for key in keys if key != 'tags' ]
+        request = ( tuple(keys), last )
+        self.lock.acquire()
+        try:
+            cached = self.lastSnapshot
+            if cached is not None and cached[0] == request and cached[1].version == self.version:
+                return cached[1]
+            data = {}
+            for key in keys:
+                stored = self.dequeDicts[key]
+                start = 0 if last is None else max( len(stored) - last, 0 )
+                data[key] = np.array( list(itertools.islice(stored, start, None)) )
+            snapshot = dataSnapshot( data, self.version )
+        finally:
+            self.lock.release()
+        for array in snapshot.values():
+            array.setflags(write=False)
+        self.lastSnapshot = ( request, snapshot )
+        return snapshot
+
+    def history(self, keys=None):
+        '''
+		Returns the stored data as a tagIndex.tagStream keyed by the requested tags.
+		The stream is rebuilt only when new data arrives, so repeated tagRange lookups are binary searches.
+		input:
+			keys: list of detectors and ROIs to include. None includes every key.
+		'''
+        snapshot = self.snapshot( keys=keys )
+        cached = self.lastHistory
+        if cached is not None and cached[0] is snapshot:
+            return cached[1]
+        stream = tagIndex.tagStream( snapshot['tags'], { key:snapshot[key] for key in snapshot.keys() if key not in ('tags','dummy') } )
+        self.lastHistory = ( snapshot, stream )
+        return stream
+
+    def tagRange(self, tagLow, tagHigh, keys=None):
+        '''
+		Returns the stored data with tagLow <= tag <= tagHigh as a tagIndex.tagStream.
+		'''
+        return self.history( keys=keys ).range( tagLow, tagHigh )
+
+    def streams(self):
+        '''
+		Returns the stored data split into tag streams for tagIndex.joinStreams: point detectors keyed by the requested
+		tags and each roi keyed by the tag its image was actually collected at. See tagIndex.streamsFromData.
+		'''
+        return tagIndex.streamsFromData( self.snapshot() )
+
     def requestStop(self):
         '''
 		Requests termination of thread.
@@ -9,7 +9,6 @@
 
 import os, io, time, sys, socket
 import numpy as np
-import pandas as pd
 
 # SACLA database library and online analysis library
 sys.path.append('/prj/SACLA_tool/lib')
@@ -17,18 +16,14 @@ import dbpy, olpy
 
 # Import custom online library
 import onlineAccess
+import liveView
 
 
-# Plot options
-import matplotlib
-matplotlib.rcParams['backend']='Qt5Agg'
-matplotlib.use('Qt5Agg')
-
-import matplotlib.pyplot as plt
-import matplotlib.widgets as widgets
-
-from roipoly import RoiPoly
+# Headless analysis workers. Plotting libraries are only imported below in __main__,
+# so processes started by multiprocessing do not load Qt or matplotlib.
+from roiWorker import isData, binROI, replayBinROI, replayTagRanges, nominalDelayPs, goodShots
 
+import functools
 import multiprocessing
 import time
 
@@ -37,6 +32,8 @@ import time
     not support display an ROI unless the graph that displays it is returned by plt.gca()
 '''
 def display_roi(roi_disp, ax, **linekwargs):
+    # pyplot is imported here, not at module level, so worker processes importing this module never load it
+    import matplotlib.pyplot as plt
     line = plt.Line2D(roi_disp.x + [roi_disp.x[0]], roi_disp.y + [roi_disp.y[0]],
                           color=roi_disp.color, **linekwargs)
     ax.add_line(line)
@@ -57,9 +54,11 @@ def getStatus(tag, hightag):
     status = onlineAccess.getEquip( (tag,), equip=machineStatusName, hightag=hightag)
     return(status[0]>0.1)
 
-def returnTenFrames( detectorName , integrateOver = 100):
-    intMPCCD = np.zeros( (NY,NX) )
-    nframes = 0
+def returnTenFrames( detectorName , integrateOver = 100, pyramid = None):
+    # frames are binned into the pyramid as they arrive, so the display only draws the level that fits the figure
+    if pyramid is None:
+        pyramid = liveView.imagePyramid()
+    pyramid.reset()
     tag = 0
     for idx in range(integrateOver):
         detFrame, tag, hightag = grabDetector(detectorName)
@@ -67,111 +66,46 @@ def returnTenFrames( detectorName , integrateOver = 100):
         if getStatus(tag,hightag) is False:
             continue
 
-        nframes += 1.
-        intMPCCD += detFrame*3.65
+        pyramid.update( detFrame*3.65, tag )
         time.sleep(1./29.)
 
-    tenFrames =  (intMPCCD/nframes)
+    if pyramid.nframes == 0:
+        raise RuntimeError('No frames with beam on %s in %d tries' % (detectorName, integrateOver))
+    tenFrames = pyramid.average(0)
     return tenFrames, tag
 
-def isData( anArray ):
-    return (np.abs(anArray)>0) & (~np.isnan(anArray))
-
-def bindata(xx, yy, binstart, binend, bins=50):
-    edges = np.linspace(binstart, binend, bins+1)
-    counts, _ = np.histogram(xx, bins=edges)
-    print(xx)
-    print(yy)
-    print(edges)
-    sums, throwaway = np.histogram(xx, bins=edges, weights=yy)
-    centers = 0.5 * (edges[:-1] + edges[1:])
-    return sums * 1./counts, centers, np.sum(xx<edges[0])+np.sum(xx>edges[-1])
-
-# bin shots Here
-'''
-    Copyright 2019 by Viktor Krapivin, claimed only on the class binROI.
-    This program is free software: you can redistribute it and/or modify
-    it under the terms of the GNU General Public License as published by
-    the Free Software Foundation, either version 2 of the License, or
-    (at your option) any later version.
-
-    This program is distributed in the hope that it will be useful,
-    but WITHOUT ANY WARRANTY; without even the implied warranty of
-    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
-    GNU General Public License for more details.
+if __name__ == '__main__':
+    # Linux forks by default, which would copy Qt and matplotlib into every worker.
+    # forkserver starts workers from a clean process that only runs the headless imports above.
+    multiprocessing.set_start_method('forkserver')
 
-    You should have received a copy of the GNU General Public License
-    along with this program.  If not, see <https://www.gnu.org/licenses/>.
-'''
-class binROI(multiprocessing.Process):
-    
-    def __init__(self, result_queue, detector, tagStart, startBin, endbin, mask, roiBins, t0offset):
-        multiprocessing.Process.__init__(self)
-        self.result_queue = result_queue
-        self.tagStart = tagStart
-        self.mask = mask
-        self.detector = detector
-        self.roiBins2 = roiBins
-        self.starterBin = startBin
-        self.enderbin = endbin
-        self.nomDelayOff = t0offset
+    # Plot options
+    import matplotlib
+    matplotlib.rcParams['backend']='Qt5Agg'
+    matplotlib.use('Qt5Agg')
 
+    import matplotlib.pyplot as plt
+    import matplotlib.widgets as widgets
 
-    def run(self):
-        proc_name = self.name
-        while True:
-            detArrer, curTag, hightager = onlineAccess.grabNewestDetector(self.detector, 3, refDet='xfel_bl_3_st_5_direct_bm_1_pd/charge')
-            if(curTag == self.tagStart):
-                #if you are having problems, you could try uncommenting below and adjusting sleep time but not required
-                #time.sleep(0.005)
-                continue
-            self.tagStart = curTag
-            #read some point detectors that are from the same tag # as retreived above.
-            detReading = onlineAccess.grabPointData(['xfel_bl_3_st_2_pd_user_5_fitting_peak/voltage', 'xfel_mon_bpm_bl3_0_3_beamstatus/summary', 'xfel_bl_3_st_2_motor_1/position'], (curTag,) , hightag=hightager)
-            i0det = detReading['xfel_bl_3_st_2_pd_user_5_fitting_peak/voltage']
-            i0det = i0det['Data']
-            i0det = np.array(i0det)
-            beamStatus = detReading['xfel_mon_bpm_bl3_0_3_beamstatus/summary']
-            beamStatus = beamStatus['Data']
-            beamStatus = np.array(beamStatus)
-            nominalDelay = detReading['xfel_bl_3_st_2_motor_1/position']
-            nominalDelay = nominalDelay['Data']
-            nominalDelay = np.array(nominalDelay)
-            idxs = isData(beamStatus) & (i0det > 0.01)
-            idxs = idxs.ravel() # this and some commands below probably should be scrutinized for performance; this is a hack used to get the variable in the right data structure
-            nominalDelay_ps = nominalDelay* 6.666e-3 - self.nomDelayOff
-            detArraysROI = np.sum(detArrer[self.mask])
-            detArraysROI = np.copy(np.array(detArraysROI).ravel())
-            if idxs[0]>0:
-                binROIs, bin_nomDel, testor = bindata(nominalDelay_ps, detArraysROI, self.starterBin, self.enderbin, bins=self.roiBins2)
-                whereIsNaN = np.isnan(binROIs)
-                binROIs[whereIsNaN] = 0
-            else:
-                binROIs = 0
-                binInts = 0
-                bin_nomDel = 0
-            self.result_queue.put_nowait((binROIs, bin_nomDel, idxs.sum(), i0det, beamStatus, detArraysROI,curTag))
-            self.tagStart = curTag
-        #once again below can be uncommented and adjusted, but there is no loss in performance unless you are running many other programs on anapc.
-        #not sleeping will just use up one core of processing on the anapc
-        # not a problem as this loop is running on a different core than the loop below
-        #time.sleep(0.005)
-        return
-#class Task(object):
+    from roipoly import RoiPoly
 
-if __name__ == '__main__':
     results = multiprocessing.Queue()
     
     # configure below for your experiment
     detectorName = 'MPCCD-8N0-3-002-6'
     integrateOver = 10
     t0offset = -10
+    # set to a run number to replay a completed run instead of following the newest tags
+    replayRunNumber = None
+    replayWorkers = 4
     
     fig = plt.figure()
-    tenFrames, curTag = returnTenFrames(detectorName, integrateOver = integrateOver)
-    plt.imshow(tenFrames)
+    framePyramid = liveView.imagePyramid()
+    tenFrames, curTag = returnTenFrames(detectorName, integrateOver = integrateOver, pyramid = framePyramid)
+    # the pyramid keeps full resolution pixel coordinates, so the mask drawn on a binned level still matches tenFrames
+    frameImage = liveView.showLevel(plt.gca(), framePyramid, average=True)
     my_roi = RoiPoly(color='r', fig=fig)
-    plt.imshow(tenFrames)
+    liveView.showLevel(plt.gca(), framePyramid, average=True, artist=frameImage)
     my_roi.display_roi()
     mask = my_roi.get_mask(tenFrames)
     
@@ -180,9 +114,28 @@ if __name__ == '__main__':
     startBin = -2.0
     endbin = 3.0
     binCounterBin = np.zeros(roiBins)
+    binSums = np.zeros(roiBins)
+
+    # the analysis every worker runs, see pipeline.py. It must output roiWorker.shotOutputs.
+    # Functions are module level or functools.partial, so the config can be sent to the worker processes.
+    # The same config drives a dataHandler with dh.setPipeline(pipeline.pipelinePlan(shotConfig)).
+    shotConfig = {
+        'channels': { 'i0':'xfel_bl_3_st_2_pd_user_5_fitting_peak/voltage',
+                      'status':'xfel_mon_bpm_bl3_0_3_beamstatus/summary',
+                      'delay':'xfel_bl_3_st_2_motor_1/position' },
+        'masks': { 'roi': {'Detector':detectorName, 'Mask':mask} },
+        'derived': { 'nominalDelay_ps': {'Inputs':['delay'], 'Function':functools.partial(nominalDelayPs, t0offset=t0offset)} },
+        'filters': { 'goodShots': {'Inputs':['status', 'i0'], 'Function':functools.partial(goodShots, i0threshold=0.01)} },
+        'binning': { 'delayScan': {'X':'nominalDelay_ps', 'Y':'roi', 'Filter':'goodShots', 'Start':startBin, 'End':endbin, 'Bins':roiBins} },
+        'outputs': ['i0', 'status', 'roi', 'goodShots', 'delayScan'] }
     
-    binTheData = binROI(results, detectorName, curTag, startBin, endbin, mask, roiBins, t0offset)
-    binTheData.start()
+    if replayRunNumber is None:
+        binTheData = [binROI(results, shotConfig, curTag)]
+    else:
+        tagRanges, replayHightag = replayTagRanges(3, replayRunNumber, replayWorkers)
+        binTheData = [replayBinROI(results, shotConfig, tagRange, replayHightag) for tagRange in tagRanges]
+    for worker in binTheData:
+        worker.start()
     binROIs = np.zeros(roiBins)
     bin_nomDel = np.zeros(roiBins)
     i0det = 0
@@ -208,15 +161,16 @@ if __name__ == '__main__':
         if results.empty() is True:
             plt.pause(0.001)
             continue
-        binROIsTemp, bin_nomDelTemp, shotsInBin, i0detTemp, beamStatusTemp, detArraysROIsTemp, tagSelTemp = results.get()
+        binROIsTemp, bin_nomDelTemp, binCountsTemp, shotsInBin, i0detTemp, beamStatusTemp, detArraysROIsTemp, tagSelTemp = results.get()
         if shotsInBin < 1:
             pass
         else:
             graphingInit = True
-            binAddMask = (binROIsTemp>0)
-            binROIs[binAddMask] = np.divide((np.multiply(binROIs[binAddMask],binCounterBin[binAddMask]) + binROIsTemp[binAddMask] ), binCounterBin[binAddMask]+1)
-            #binCounterBin[binAddMask] = binCounterBin[binAddMask] + 1 # works but below should be better if binROI is rewritten to get more than 1 event
-            binCounterBin =  np.add(binCounterBin[binAddMask], binROIsTemp)
+            # count weighted mean, so results covering one shot or a whole replay chunk combine correctly
+            binSums += binROIsTemp*binCountsTemp
+            binCounterBin += binCountsTemp
+            filledBins = binCounterBin > 0
+            binROIs[filledBins] = binSums[filledBins] / binCounterBin[filledBins]
             bin_nomDel = bin_nomDelTemp
             totalShots = totalShots + shotsInBin
         if type(i0det) is int:
@@ -253,5 +207,6 @@ if __name__ == '__main__':
         
         fig.canvas.draw()
         plt.pause(0.001)
-    binTheData.terminate()
+    for worker in binTheData:
+        worker.terminate()
     
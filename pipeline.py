@@ -0,0 +1,237 @@
+'''
+pipeline.py
+
+Declarative analysis pipelines.
+A pipeline is declared as a dictionary of channels, rois, masks, derived quantities, filters and binnings.
+pipelinePlan builds the dependency graph, keeps only the branches needed for the requested outputs,
+reads each point detector and each detector frame once per tag, and computes every intermediate once.
+
+Example:
+    config = { 'channels': { 'i0':'xfel_bl_3_st_2_pd_user_5_fitting_peak/voltage',
+                             'status':'xfel_mon_bpm_bl3_0_3_beamstatus/summary',
+                             'delay':'xfel_bl_3_st_2_motor_1/position' },
+               'rois': { 'ROI1': {'Detector':'MPCCD-1-1-010', 'X1':1, 'X2':10, 'Y1':1, 'Y2':10} },
+               'masks': { 'ring': {'Detector':'MPCCD-1-1-010', 'Mask':ringMask} },
+               'derived': { 'norm': {'Inputs':['ROI1','i0'], 'Function':lambda roi, i0: roi/i0},
+                            'delay_ps': {'Inputs':['delay'], 'Function':lambda delay: delay*6.666e-3} },
+               'filters': { 'good': {'Inputs':['status','i0'], 'Function':lambda status, i0: (status > 0) & (i0 > 0.01)} },
+               'binning': { 'scan': {'X':'delay_ps', 'Y':'norm', 'Filter':'good', 'Start':-2., 'End':3., 'Bins':40} },
+               'outputs': ['i0', 'norm', 'good', 'delay_ps', 'scan'] }
+    plan = pipeline.pipelinePlan( config )
+    values = plan.evaluate( tags, hightag )   # or dh.setPipeline( plan )
+
+'''
+
+import numpy as np
+
+# Import custom online library
+import onlineAccess
+
+def binValues( xx, yy, start, end, bins=50, select=None ):
+    '''
+    Averages yy in bins of xx
+    input:
+        xx, yy: arrays of the same length
+        start, end, bins: bin edges are linspace(start, end, bins+1)
+        select: optional boolean array, only these entries are binned
+    output:
+        mean of yy in each bin (nan for empty bins), bin centers, counts in each bin
+    '''
+    xx = np.asarray(xx, dtype=float)
+    yy = np.asarray(yy, dtype=float)
+    good = ~( np.isnan(xx) | np.isnan(yy) )
+    if select is not None:
+        good &= np.asarray(select, dtype=bool)
+    edges = np.linspace( start, end, bins+1 )
+    counts, _ = np.histogram( xx[good], bins=edges )
+    sums, _ = np.histogram( xx[good], bins=edges, weights=yy[good] )
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = sums / counts
+    centers = 0.5 * (edges[:-1] + edges[1:])
+    return means, centers, counts
+
+class pipelinePlan(object):
+    '''
+        Dependency graph and evaluation order for a declared pipeline.
+        Node kinds are 'channel' (point detector), 'frame' (calibrated detector frame, internal),
+        'roi', 'mask', 'derived', 'filter' and 'binning'. Only binning outputs are not per tag.
+    '''
+    def __init__(self, config):
+        '''
+            input:
+                config: dictionary with any of the keys
+                    channels: list of point detector names, or dictionary of name: point detector
+                    rois: dictionary of rectangular rois as used by onlineAccess.grabROIData
+                    masks: dictionary of name: {'Detector':det, 'Mask':boolean array the shape of a frame}
+                    derived: dictionary of name: {'Inputs':[names], 'Function':f}. f is called with the input arrays.
+                    filters: like derived, but the result is cast to a boolean array
+                    binning: dictionary of name: {'X':name, 'Y':name, 'Filter':name or None, 'Start':, 'End':, 'Bins':}
+                    outputs: names to compute. Defaults to every declared name.
+        '''
+        self.nodes = {}
+
+        channels = config.get('channels', [])
+        if not isinstance(channels, dict):
+            channels = { equip:equip for equip in channels }
+        for name, equip in channels.items():
+            self.addNode( name, 'channel', [], Equipment=equip )
+
+        for kind, key in ( ('roi','rois'), ('mask','masks') ):
+            for name, spec in config.get(key, {}).items():
+                frameName = 'frame:'+spec['Detector']
+                if frameName not in self.nodes:
+                    self.addNode( frameName, 'frame', [], Detector=spec['Detector'] )
+                self.addNode( name, kind, [frameName], **spec )
+
+        for kind, key in ( ('derived','derived'), ('filter','filters') ):
+            for name, spec in config.get(key, {}).items():
+                self.addNode( name, kind, list(spec['Inputs']), Function=spec['Function'] )
+
+        for name, spec in config.get('binning', {}).items():
+            inputs = [ spec['X'], spec['Y'] ] + ( [spec['Filter']] if spec.get('Filter') is not None else [] )
+            self.addNode( name, 'binning', inputs, **spec )
+
+        outputs = config.get('outputs')
+        if outputs is None:
+            outputs = [ name for name in self.nodes if self.nodes[name]['Kind'] != 'frame' ]
+        self.outputs = list(outputs)
+        self.order = self.resolve( self.outputs )
+        self.channels, self.detectors = self.readsOf( self.order )
+        self.perTagOutputs = [ name for name in self.outputs if self.nodes[name]['Kind'] != 'binning' ]
+
+    def addNode(self, name, kind, inputs, **spec):
+        if name in self.nodes:
+            raise ValueError('%s is declared twice' % name)
+        node = dict(spec)
+        node['Kind'] = kind
+        node['Inputs'] = inputs
+        self.nodes[name] = node
+
+    def resolve(self, outputs):
+        '''
+            Returns the nodes needed for outputs in dependency order. Nodes nobody needs are left out.
+        '''
+        order = []
+        state = {}
+        def visit( name, neededBy ):
+            if name not in self.nodes:
+                raise ValueError('Unknown input %s needed by %s' % (name, neededBy))
+            if state.get(name) == 'done':
+                return
+            if state.get(name) == 'visiting':
+                raise ValueError('Pipeline has a cycle through %s' % name)
+            state[name] = 'visiting'
+            for inputName in self.nodes[name]['Inputs']:
+                visit( inputName, name )
+            state[name] = 'done'
+            order.append( name )
+        for name in outputs:
+            visit( name, 'outputs' )
+        return order
+
+    def readsOf(self, order):
+        '''
+            Returns the point detector nodes and a dictionary of detector: roi and mask nodes read for the nodes in order
+        '''
+        channels = [ name for name in order if self.nodes[name]['Kind'] == 'channel' ]
+        detectors = {}
+        for name in order:
+            if self.nodes[name]['Kind'] in ('roi', 'mask'):
+                detectors.setdefault( self.nodes[name]['Detector'], [] ).append( name )
+        return channels, detectors
+
+    def evaluate(self, tags, hightag=201901, returnRealTags=False, outputs=None):
+        '''
+            Computes every needed node for tags
+            input:
+                tags: tuple of integers containing the low tag value
+                hightag: hightag integer
+                returnRealTags: if True, also return the collected tags for each detector, nan where the frame was not used
+                outputs: names to compute instead of the declared outputs. Only the nodes they need are read and computed.
+            output:
+                dictionary of name: values for every needed node, per tag arrays except for binning outputs.
+                Image values are nan where the frame could not be read for that tag.
+                if returnRealTags: values, dictionary of detector: collected tags
+        '''
+        if outputs is None:
+            order, channels, detectors = self.order, self.channels, self.detectors
+        else:
+            order = self.resolve( outputs )
+            channels, detectors = self.readsOf( order )
+        tags = tuple(tags)
+        values = {}
+
+        # raw point detectors, one bulk read
+        if len(channels) > 0:
+            pointMatrix = onlineAccess.grabPointMatrix( [ self.nodes[name]['Equipment'] for name in channels ], tags, hightag=hightag )
+            for col, name in enumerate(channels):
+                values[name] = pointMatrix[:,col]
+
+        # raw frames, read once per tag and shared by every roi and mask on the detector
+        realTags = {}
+        for det, consumers in detectors.items():
+            for name in consumers:
+                values[name] = np.full( len(tags), np.nan )
+            realTags[det] = np.full( len(tags), np.nan )
+            for idx, realtag, frame in onlineAccess.iterCalibratedFrames( det, tags, hightag=hightag ):
+                if frame is None or realtag != tags[idx]:
+                    # the value stays nan, so it is not recorded as collected either
+                    continue
+                realTags[det][idx] = realtag
+                for name in consumers:
+                    node = self.nodes[name]
+                    if node['Kind'] == 'roi':
+                        values[name][idx] = np.nansum( frame[node['Y1']:node['Y2'], node['X1']:node['X2']] )
+                    else:
+                        values[name][idx] = np.nansum( frame[node['Mask']] )
+
+        for name in order:
+            node = self.nodes[name]
+            if node['Kind'] in ('derived', 'filter'):
+                result = np.asarray( node['Function']( *[ values[inputName] for inputName in node['Inputs'] ] ) )
+                values[name] = result.astype(bool) if node['Kind'] == 'filter' else result
+            elif node['Kind'] == 'binning':
+                values[name] = self.binned( name, values )
+
+        if returnRealTags:
+            return values, realTags
+        return values
+
+    def binned(self, name, data):
+        '''
+            Computes binning output name from per tag arrays, eg from evaluate or from dataHandler.snapshot
+            output: mean in each bin, bin centers, counts in each bin
+        '''
+        node = self.nodes[name]
+        select = data[node['Filter']] if node.get('Filter') is not None else None
+        return binValues( data[node['X']], data[node['Y']], node['Start'], node['End'], bins=node['Bins'], select=select )
+
+    def detectorsOf(self, name):
+        '''
+            Returns the detectors a node depends on
+        '''
+        node = self.nodes[name]
+        if node['Kind'] == 'frame':
+            return set([ node['Detector'] ])
+        dets = set()
+        for inputName in node['Inputs']:
+            dets |= self.detectorsOf( inputName )
+        return dets
+
+    def grabData(self, tags, hightag=201901, returnRealTags=False):
+        '''
+            Evaluates the per tag outputs in the structure returned by onlineAccess.grabData, for use by dataHandler
+            If returnRealTags, outputs that depend on a detector hold its collected tags under 'RealTags'.
+            Binning outputs are not computed here, dataHandler keeps per tag values only.
+        '''
+        values, realTags = self.evaluate( tags, hightag=hightag, returnRealTags=True, outputs=self.perTagOutputs )
+        data = { name:{'Data':values[name]} for name in self.perTagOutputs }
+        if returnRealTags:
+            for name in self.perTagOutputs:
+                dets = self.detectorsOf( name )
+                if len(dets) > 0:
+                    # a tag counts as collected only if every detector the output depends on returned it
+                    collected = [ realTags[det] for det in sorted(dets) ]
+                    data[name]['RealTags'] = np.where( np.all( [ col == collected[0] for col in collected ], axis=0 ), collected[0], np.nan )
+        data['tags'] = tuple(tags)
+        return data
@@ -0,0 +1,316 @@
+'''
+publisher.py
+
+Shares a single acquisition stream between many local viewers.
+dataPublisher is a dataHandler that also broadcasts every batch of grabbed tags over a local socket.
+dataSubscriber is a dataHandler that fills its deques from a publisher instead of from dbpy/olpy,
+so any number of notebooks or plots only cost one set of reads on the facility database.
+
+Example, in the process that talks to the database:
+    pub = publisher.dataPublisher( address=('localhost', 6000), bl=3, refDet=refDet, ngrab=120 )
+    pub.setPointDetector( pointDetectors )
+    pub.setROIs( rois )
+    pub.start()
+and in every viewer run by the same user:
+    dh = publisher.dataSubscriber( address=('localhost', 6000) )
+The publisher generates a random authkey and writes it to a file only its user can read (see authkeyPath),
+which the subscriber reads. Connections carry pickles, so never share that key with other users.
+    dh.start()
+    snapshot = dh.snapshot( last=2000 )
+
+'''
+
+import os
+import time
+import threading
+import collections
+from multiprocessing.connection import Listener, Client
+
+import numpy as np
+
+# Import custom online library
+import onlineAccess
+import tagIndex
+
+def authkeyPath( address ):
+    '''
+    Returns the file the publisher at address writes its authkey to
+    '''
+    host, port = address
+    return os.path.join( os.path.expanduser('~'), '.sacla-online', 'publisher-%s-%d.key' % (host, port) )
+
+def writeAuthkey( path ):
+    '''
+    Generates a random authkey and writes it to path, readable and writable only by the current user
+    output: the authkey
+    '''
+    authkey = os.urandom(32)
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs( directory, 0o700 )
+    if os.path.exists(path):
+        # os.open only applies the mode to new files
+        os.remove(path)
+    fd = os.open( path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600 )
+    with os.fdopen( fd, 'wb' ) as keyFile:
+        keyFile.write( authkey )
+    return authkey
+
+def readAuthkey( path ):
+    '''
+    Reads an authkey written by writeAuthkey
+    '''
+    with open( path, 'rb' ) as keyFile:
+        return keyFile.read()
+
+class subscriberLink(threading.Thread):
+    '''
+        Sends queued messages to one subscriber connection.
+        The queue is bounded, so a slow subscriber loses its oldest messages instead of slowing down the publisher.
+    '''
+    def __init__(self, conn, maxQueue=100):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.conn = conn
+        self.queue = collections.deque([], maxQueue)
+        self.condition = threading.Condition()
+        self.dropped = 0
+        self.closed = False
+
+    def put(self, message):
+        '''
+            Queues a message, dropping the oldest queued message if the queue is full
+        '''
+        with self.condition:
+            if len(self.queue) == self.queue.maxlen:
+                self.dropped += 1
+            self.queue.append( message )
+            self.condition.notify()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while len(self.queue) == 0 and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    break
+                message = self.queue.popleft()
+            try:
+                self.conn.send( message )
+            except Exception as ex:
+                onlineAccess.logPrint('Subscriber disconnected: '+str(ex))
+                self.closed = True
+                break
+        try:
+            self.conn.close()
+        except Exception:
+            pass
+
+class dataPublisher(onlineAccess.dataHandler):
+    '''
+        A dataHandler that broadcasts every batch of grabbed tags to local subscribers.
+        New subscribers first receive the newest historyTags stored tags, then the live stream.
+    '''
+    def __init__(self, address=('localhost', 6000), authkey=None, historyTags=2000, maxQueue=100,
+                 frameDetectors=None, sparse=True, **kwargs):
+        '''
+            input:
+                address: (host, port) to listen on. Use localhost so only the anapc itself can subscribe.
+                authkey: shared key subscribers must present. If None, a random key is generated and written to authkeyPath(address).
+                historyTags: number of stored tags sent to a subscriber when it connects
+                maxQueue: number of messages queued per subscriber before the oldest are dropped
+                frameDetectors: list of detector names. The newest frame of each batch is published for these.
+                sparse: publish frames as onlineAccess.sparseFrames photon lists instead of dense arrays
+                kwargs: passed to onlineAccess.dataHandler
+        '''
+        onlineAccess.dataHandler.__init__(self, **kwargs)
+        self.address = address
+        if authkey is None:
+            authkey = writeAuthkey( authkeyPath(address) )
+        self.authkey = authkey
+        self.historyTags = historyTags
+        self.maxQueue = maxQueue
+        self.frameDetectors = [] if frameDetectors is None else frameDetectors
+        self.sparse = sparse
+        self.links = []
+        self.linksLock = threading.Lock()
+        self.listener = None
+
+    def run(self):
+        '''
+            Starts listening for subscribers and runs the dataHandler acquisition loop.
+        '''
+        self.listener = Listener( self.address, authkey=self.authkey )
+        acceptThread = threading.Thread( target=self.acceptSubscribers )
+        acceptThread.daemon = True
+        acceptThread.start()
+        try:
+            onlineAccess.dataHandler.run(self)
+        finally:
+            self.closeLinks()
+
+    def acceptSubscribers(self):
+        '''
+            Accepts subscriber connections until the listener is closed.
+            Called within thread. Not for user use.
+        '''
+        while not self.stopped:
+            try:
+                conn = self.listener.accept()
+            except Exception as ex:
+                if not self.stopped:
+                    onlineAccess.logPrint('Publisher could not accept subscriber: '+str(ex))
+                    continue
+                break
+            link = subscriberLink( conn, maxQueue=self.maxQueue )
+            # holding linksLock means no batch is published between the history snapshot and adding the link
+            with self.linksLock:
+                snapshot = self.snapshot( last=self.historyTags )
+                # skip the nan placeholder every dataHandler deque starts with
+                grabbed = ~np.isnan( np.asarray(snapshot['tags'], dtype=float) )
+                link.put( self.makeMessage( snapshot['tags'][grabbed],
+                                            { key:snapshot[key][grabbed] for key in snapshot.keys() if key not in ('tags','dummy') },
+                                            snapshot.version ) )
+                self.links.append( link )
+            link.start()
+            self.status += ', subscriber connected'
+
+    def makeMessage(self, tags, channels, version, frames=None):
+        return { 'version':version, 'tags':tuple(tags), 'channels':channels, 'frames':{} if frames is None else frames }
+
+    def grabFrames(self, tag):
+        '''
+            Grabs the frame at tag for every frame detector.
+            Called within thread. Not for user use.
+        '''
+        frames = {}
+        if len(self.frameDetectors) == 0:
+            return frames
+        hightag = onlineAccess.getNewestHighTag( self.bl )
+        for det in self.frameDetectors:
+            try:
+                frame = onlineAccess.grabDetector( det, (tag,), hightag=hightag, sparse=self.sparse )
+            except Exception as ex:
+                onlineAccess.logPrint(str(ex))
+                continue
+            frames[det] = ( tag, frame )
+        return frames
+
+    def updateDeques(self, data):
+        '''
+            Stores the data like dataHandler.updateDeques, then queues it for every subscriber.
+            Called within thread. Not for user use.
+        '''
+        onlineAccess.dataHandler.updateDeques(self, data)
+        tags = data['tags']
+        channels = { key:np.asarray(data[key]['Data']) for key in data.keys() if key != 'tags' }
+        for key in data.keys():
+            if key != 'tags' and 'RealTags' in data[key]:
+                channels[key+tagIndex.realTagSuffix] = np.asarray(data[key]['RealTags'])
+        frames = self.grabFrames( max(tags) ) if len(tags) > 0 else {}
+        message = self.makeMessage( tags, channels, self.version, frames )
+        with self.linksLock:
+            self.links = [ link for link in self.links if not link.closed ]
+            for link in self.links:
+                link.put( message )
+
+    def closeLinks(self):
+        with self.linksLock:
+            for link in self.links:
+                link.close()
+            self.links = []
+
+    def requestStop(self):
+        '''
+            Requests termination of thread and stops accepting subscribers.
+        '''
+        onlineAccess.dataHandler.requestStop(self)
+        if self.listener is not None:
+            self.listener.close()
+
+    def subscriberStatus(self):
+        '''
+            Returns the number of connected subscribers and the messages dropped for slow subscribers.
+        '''
+        with self.linksLock:
+            links = [ link for link in self.links if not link.closed ]
+        return '%d subscribers, %d messages dropped' % ( len(links), sum( link.dropped for link in links ) )
+
+class dataSubscriber(onlineAccess.dataHandler):
+    '''
+        A dataHandler that receives its data from a dataPublisher instead of the database.
+        Channels are created as they arrive. Read them with snapshot or indexing as with dataHandler.
+    '''
+    def __init__(self, address=('localhost', 6000), authkey=None, maxTags2Save=2000):
+        '''
+            input:
+                address: (host, port) of the publisher
+                authkey: key the publisher was started with. If None, it is read from authkeyPath(address).
+                maxTags2Save: number of event information to store at a time
+        '''
+        onlineAccess.dataHandler.__init__(self, maxTags2Save=maxTags2Save)
+        self.address = address
+        if authkey is None:
+            authkey = readAuthkey( authkeyPath(address) )
+        self.authkey = authkey
+        self.frames = {}
+        self.publisherVersion = None
+        self.missedMessages = 0
+
+    def run(self):
+        '''
+            Main thread. Receives data from the publisher until requestStop is called or the publisher stops.
+        '''
+        conn = Client( self.address, authkey=self.authkey )
+        self.status += ', subscribed'
+        self.last_status = 'subscribed'
+        try:
+            while self.stopped is not True:
+                if not conn.poll(0.1):
+                    continue
+                try:
+                    message = conn.recv()
+                except EOFError:
+                    break
+                self.receive( message )
+        finally:
+            conn.close()
+        self.status += ', run completed.'
+        self.last_status = 'run completed'
+
+    def receive(self, message):
+        '''
+            Stores a message from the publisher.
+            Called within thread. Not for user use.
+        '''
+        if self.publisherVersion is not None:
+            if message['version'] <= self.publisherVersion:
+                # already contained in the history sent on connecting
+                return
+            self.missedMessages += message['version'] - self.publisherVersion - 1
+        self.publisherVersion = message['version']
+
+        self.lock.acquire()
+        for key in message['channels'].keys():
+            if key not in self.dequeDicts:
+                # pad so the new channel stays aligned with the stored tags
+                self.dequeDicts[key] = collections.deque( [np.nan]*len(self.dequeDicts['tags']), self.maxTags2Save )
+        self.lock.release()
+
+        channels = message['channels']
+        data = { key:{'Data':values} for key, values in channels.items() if not key.endswith(tagIndex.realTagSuffix) }
+        for key in data.keys():
+            # real tags travel as their own channel and are stored by updateDeques next to their values
+            if key+tagIndex.realTagSuffix in channels:
+                data[key]['RealTags'] = channels[key+tagIndex.realTagSuffix]
+        data['tags'] = message['tags']
+        if len(data['tags']) > 0:
+            self.newestTag = np.nanmax(data['tags'])
+        self.updateDeques( data )
+        self.frames.update( message['frames'] )
+        self.totalGrabbed = len(self.dequeDicts['tags'])
@@ -0,0 +1,158 @@
+'''
+    Headless workers for operatorROI: evaluation of a declared shot pipeline and the binROI processes.
+    Only numpy, onlineAccess and pipeline are imported, so worker processes do not pay for matplotlib, Qt or pandas.
+    Contributors: Viktor Krapivin and Peihao Sun.
+    Based from SACLA Online Analysis 2019 by Matthew Ware, Takihiro Sato, Kathryn Ledbetter, and Jordan O'Neal
+'''
+
+import numpy as np
+
+# Import custom online library
+import onlineAccess
+import pipeline
+
+import multiprocessing
+
+def isData( anArray ):
+    return (np.abs(anArray)>0) & (~np.isnan(anArray))
+
+# outputs every shot pipeline declares for processShots:
+# i0, beam status, roi value per shot, the good shot filter and the roi binned by delay
+shotOutputs = ['i0', 'status', 'roi', 'goodShots', 'delayScan']
+
+# Picklable pipeline functions. Bind parameters with functools.partial, so a shot config can be sent to worker processes.
+def nominalDelayPs( position, t0offset=0. ):
+    '''
+        Converts the delay stage position to the nominal delay in ps
+    '''
+    return position* 6.666e-3 - t0offset
+
+def goodShots( beamStatus, i0det, i0threshold=0.01 ):
+    '''
+        Selects shots with beam and an I0 above i0threshold
+    '''
+    return isData(beamStatus) & (i0det > i0threshold)
+
+def checkShotConfig( config ):
+    '''
+        Builds the pipeline of a shot config, raising ValueError if it is inconsistent or lacks one of shotOutputs
+        output:
+            pipeline.pipelinePlan
+    '''
+    plan = pipeline.pipelinePlan( config )
+    missing = [ name for name in shotOutputs if name not in plan.outputs ]
+    if len(missing) > 0:
+        raise ValueError('Shot pipeline does not output %s' % missing)
+    return plan
+
+def processShots(plan, tags, hightag):
+    '''
+        Evaluates a shot pipeline for tags, shared by the live and replay paths
+        input:
+            plan: pipeline from checkShotConfig
+            tags: tuple of tags
+            hightag: hightag integer
+        output:
+            binned roi, bin centers, good shots in each bin, number of good shots, i0, beam status, roi per shot, tags
+            Empty bins hold 0, so combine results with a count weighted mean.
+    '''
+    values = plan.evaluate(tags, hightag=hightag)
+    idxs = values['goodShots']
+    binROIs, bin_nomDel, binCounts = values['delayScan']
+    whereIsNaN = np.isnan(binROIs)
+    binROIs[whereIsNaN] = 0
+    return (binROIs, bin_nomDel, binCounts, idxs.sum(), values['i0'], values['status'], values['roi'], tags)
+
+# bin shots Here
+'''
+    Copyright 2019 by Viktor Krapivin, claimed only on the class binROI.
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+class binROI(multiprocessing.Process):
+    
+    def __init__(self, result_queue, config, tagStart):
+        '''
+            input:
+                result_queue: multiprocessing queue receiving the processShots results
+                config: pipeline config declaring shotOutputs, with picklable functions (see nominalDelayPs)
+                tagStart: last tag already processed
+        '''
+        multiprocessing.Process.__init__(self)
+        self.result_queue = result_queue
+        self.tagStart = tagStart
+        # checked here so a bad config fails in the calling process instead of inside the worker
+        checkShotConfig(config)
+        self.config = config
+
+
+    def makePipeline(self):
+        # the config is sent to the worker process, the plan is built there
+        return checkShotConfig(self.config)
+
+    def run(self):
+        proc_name = self.name
+        plan = self.makePipeline()
+        while True:
+            curTag = onlineAccess.getNewestTag('xfel_bl_3_st_5_direct_bm_1_pd/charge')
+            if(curTag == self.tagStart):
+                #if you are having problems, you could try uncommenting below and adjusting sleep time but not required
+                #time.sleep(0.005)
+                continue
+            self.tagStart = curTag
+            hightager = onlineAccess.getNewestHighTag(3)
+            #the image and the point detectors are read for the same tag # by the pipeline
+            self.result_queue.put_nowait(processShots(plan, (curTag,), hightager))
+            self.tagStart = curTag
+        #once again below can be uncommented and adjusted, but there is no loss in performance unless you are running many other programs on anapc.
+        #not sleeping will just use up one core of processing on the anapc
+        # not a problem as this loop is running on a different core than the loop below
+        #time.sleep(0.005)
+        return
+
+class replayBinROI(binROI):
+    '''
+        Runs the binROI analysis over a fixed tag range of a completed run as fast as the backend allows, chunkSize tags at a time.
+        Results are put on the queue in the same format as binROI, one entry per chunk.
+        Start several of these on disjoint tag ranges (see replayTagRanges) to replay in parallel.
+        NOTE: images are read through olpy, so this only works while the run is still held by the online storage.
+    '''
+    def __init__(self, result_queue, config, tags, hightag, chunkSize=100):
+        binROI.__init__(self, result_queue, config, None)
+        self.tags = tags
+        self.hightag = hightag
+        self.chunkSize = chunkSize
+
+    def run(self):
+        plan = self.makePipeline()
+        for idx in range(0, len(self.tags), self.chunkSize):
+            chunk = tuple(self.tags[idx:idx+self.chunkSize])
+            try:
+                result = processShots(plan, chunk, self.hightag)
+            except Exception as ex:
+                onlineAccess.logPrint('Could not replay tags %d to %d: %s' % (chunk[0], chunk[-1], str(ex)))
+                continue
+            self.result_queue.put(result)
+        return
+
+def replayTagRanges( bl, run, nworkers ):
+    '''
+        Splits the tags of a run into nworkers contiguous ranges
+        output: list of tag ranges, hightag
+    '''
+    startTag, endTag = onlineAccess.getTagRange(bl, run)
+    allTags = range(startTag[1], endTag[1]+1)
+    nper = int(np.ceil(len(allTags)*1./nworkers))
+    return [ allTags[idx:idx+nper] for idx in range(0, len(allTags), nper) ], startTag[0]
+
+#class Task(object):
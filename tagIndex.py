@@ -0,0 +1,147 @@
+'''
+tagIndex.py
+
+Tag indexed streams and vectorized joins.
+A tagStream holds values keyed by the tag each sample actually belongs to, kept sorted so a tag range is
+found with a binary search. joinStreams matches several streams on tag (inner, outer or as-of) without
+relying on the position of samples in the requested tag tuple.
+
+Example, correlating an ROI with I0 over the history of a dataHandler:
+    streams = tagIndex.streamsFromData( dh.snapshot() )
+    tags, values = tagIndex.joinStreams( [ streams['points'], streams['ROI1'] ], how='inner' )
+    plt.scatter( values['xfel_bl_3_st_5_direct_bm_1_pd/charge'], values['ROI1'] )
+
+'''
+
+import numpy as np
+
+realTagSuffix = ':realtag'
+
+class tagStream(object):
+    '''
+        Columns of values indexed by a sorted array of tags.
+    '''
+    def __init__(self, tags, columns, isSorted=False):
+        '''
+            input:
+                tags: tag of each sample. Samples with a nan tag (never collected) are dropped.
+                    If a tag repeats, only its last sample is kept, eg when two requested tags returned the same frame.
+                columns: dictionary of name: array of values, one per tag
+                isSorted: set if tags are already increasing to skip the sort
+        '''
+        tags = np.asarray(tags, dtype=float)
+        keep = ~np.isnan(tags)
+        order = np.flatnonzero(keep)
+        if not isSorted:
+            order = order[ np.argsort(tags[order], kind='mergesort') ]
+        # the sort is stable, so the last of equal tags is the newest sample
+        last = np.ones( len(order), dtype=bool )
+        last[:-1] = tags[order][1:] != tags[order][:-1]
+        order = order[last]
+        self.tags = tags[order].astype(np.int64)
+        self.columns = { name:np.asarray(values)[order] for name, values in columns.items() }
+
+    def __len__(self):
+        return len(self.tags)
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def keys(self):
+        return self.columns.keys()
+
+    def range(self, tagLow, tagHigh):
+        '''
+            Returns the samples with tagLow <= tag <= tagHigh as a new tagStream, found by binary search
+        '''
+        low = np.searchsorted( self.tags, tagLow, side='left' )
+        high = np.searchsorted( self.tags, tagHigh, side='right' )
+        return tagStream( self.tags[low:high], { name:values[low:high] for name, values in self.columns.items() }, isSorted=True )
+
+    def lookup(self, tags):
+        '''
+            Returns the position of each tag in the stream, or -1 where the stream has no sample at that tag
+        '''
+        tags = np.asarray(tags, dtype=np.int64)
+        positions = np.searchsorted( self.tags, tags, side='left' )
+        found = positions < len(self.tags)
+        found[found] = self.tags[positions[found]] == tags[found]
+        return np.where( found, positions, -1 )
+
+    def lookupAsOf(self, tags, tolerance=None):
+        '''
+            Returns the position of the last sample at or before each tag, or -1 if there is none within tolerance tags
+        '''
+        tags = np.asarray(tags, dtype=np.int64)
+        positions = np.searchsorted( self.tags, tags, side='right' ) - 1
+        found = positions >= 0
+        if tolerance is not None:
+            found[found] = ( tags[found] - self.tags[positions[found]] ) <= tolerance
+        return np.where( found, positions, -1 )
+
+    def take(self, positions):
+        '''
+            Returns each column at positions, with nan where the position is -1
+        '''
+        positions = np.asarray(positions)
+        found = positions >= 0
+        columns = {}
+        for name, values in self.columns.items():
+            taken = np.full( len(positions), np.nan )
+            taken[found] = values[positions[found]]
+            columns[name] = taken
+        return columns
+
+def joinStreams( streams, how='inner', tolerance=None ):
+    '''
+    Matches the samples of several tagStreams by tag
+    input:
+        streams: list of tagStreams. Column names must not repeat between streams.
+        how: 'inner' keeps tags present in every stream,
+             'outer' keeps tags present in any stream, with nan where a stream has no sample,
+             'asof' keeps the tags of the first stream and takes the last sample at or before each tag from the others
+        tolerance: for 'asof', the largest allowed tag difference
+    output:
+        joined tags, dictionary of column name: values aligned with the joined tags
+    '''
+    names = [ name for stream in streams for name in stream.keys() ]
+    if len(names) != len(set(names)):
+        raise ValueError('Column names repeat between streams: %s' % names)
+
+    if how == 'inner':
+        tags = streams[0].tags
+        for stream in streams[1:]:
+            tags = np.intersect1d( tags, stream.tags )
+    elif how == 'outer':
+        tags = streams[0].tags
+        for stream in streams[1:]:
+            tags = np.union1d( tags, stream.tags )
+    elif how == 'asof':
+        tags = streams[0].tags
+    else:
+        raise ValueError('Unknown join %s' % how)
+
+    columns = {}
+    for idx, stream in enumerate(streams):
+        if how == 'asof' and idx > 0:
+            positions = stream.lookupAsOf( tags, tolerance=tolerance )
+        else:
+            positions = stream.lookup( tags )
+        columns.update( stream.take(positions) )
+    return tags, columns
+
+def streamsFromData( data ):
+    '''
+    Splits dataHandler data into tag streams
+    input:
+        data: dictionary of arrays, eg from dataHandler.snapshot
+    output:
+        dictionary with 'points': every channel without a recorded real tag, keyed by the requested tag,
+        and one stream per channel with a recorded real tag (eg rois), keyed by the tag the detector actually returned
+    '''
+    imageNames = [ key[:-len(realTagSuffix)] for key in data.keys() if key.endswith(realTagSuffix) ]
+    pointNames = [ key for key in data.keys() if key not in ('tags', 'dummy') and not key.endswith(realTagSuffix) and key not in imageNames ]
+    streams = { 'points': tagStream( data['tags'], { name:data[name] for name in pointNames } ) }
+    for name in imageNames:
+        streams[name] = tagStream( data[name+realTagSuffix], { name:data[name] } )
+    return streams